@@ -1,35 +1,92 @@
 import streamlit as st
 from pubchempy import get_compounds
-from chembl_webresource_client.new_client import new_client
 import pandas as pd
-import spacy
-from tenacity import retry, stop_after_attempt
-import socket
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
 import logging
+import asyncio
+import functools
+import hashlib
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import diskcache
+import requests
+from requests.adapters import HTTPAdapter
 
 # --- Configuration ---
 st.set_page_config(page_title="Drug-Info", page_icon="🧪", layout="wide")
 logging.basicConfig(filename='curegenie.log', level=logging.INFO, filemode='w')
 
-def check_internet():
-    try:
-        socket.create_connection(("www.google.com", 80), timeout=5)
-        return True
-    except OSError:
-        return False
+CHEMBL_API = "https://www.ebi.ac.uk/chembl/api/data"
+PUBCHEM_API = "https://pubchem.ncbi.nlm.nih.gov/rest/pug"
+PUBCHEM_PROPERTIES = "IUPACName,MolecularFormula,MolecularWeight,CanonicalSMILES,InChIKey"
+
+# Persistent response cache shared by every worker and surviving restarts.
+# Entries are fresh for CACHE_TTL and kept a while longer as a stale fallback when the APIs fail.
+# For multiple replicas, swap this for a redis.Redis client with the same get/set shape.
+CACHE_TTL = 3600
+STALE_TTL = 7 * 24 * 3600
+# Per-source TTLs: PubChem structures practically never change, ChEMBL IDs are stable
+# across releases, activity assays are refreshed with each ChEMBL release
+PUBCHEM_TTL = 30 * 24 * 3600
+CHEMBL_ID_TTL = 7 * 24 * 3600
+CHEMBL_ACTIVITY_TTL = 24 * 3600
+@st.cache_resource
+def _disk_cache():
+    return diskcache.Cache('.curegenie_cache', size_limit=500_000_000)
 
-if not check_internet():
-    st.error("⚠ No internet connection. Some features may be limited.")
-    st.stop()
+cache = _disk_cache()
+# Only the fields main() renders are returned and cached; the debug log lives in session state
+VIEW_FIELDS = ('cid', 'name', 'formula', 'weight', 'smiles', 'inchi_key', 'bioactivities')
 
+# Shared keep-alive session so repeated PubChem/ChEMBL calls reuse the same TCP/TLS connections.
+# Cached so the pool survives reruns instead of being rebuilt on every click.
 @st.cache_resource
-def load_models():
-    try:
-        nlp = spacy.load("en_core_web_sm")
-        return nlp
-    except Exception as e:
-        st.warning(f"⚠ NLP model not available: {e}")
-        return None
+def _http_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    return session
+
+SESSION = _http_session()
+
+class TokenBucket:
+    """Thread-safe token bucket limiting outbound calls to `rpm` requests per minute."""
+
+    def __init__(self, rpm, burst=None):
+        self.rpm = rpm
+        self.rate = rpm / 60.0
+        self.capacity = burst or max(1, rpm // 60)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            # A negative balance is a reservation: wait until it has refilled
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time:
+            time.sleep(wait_time)
+
+# Long-lived worker pool for the blocking HTTP calls. asyncio.run() would otherwise
+# spin up and tear down a fresh default executor on every Analyze click.
+@st.cache_resource
+def _executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="fetch")
+
+async def _run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor(), func, *args)
+
+# PubChem allows 5 requests/second; ChEMBL is more lenient but still throttles bursts.
+# Cached so every session and rerun draws from the same budget.
+@st.cache_resource
+def _rate_limiters():
+    return TokenBucket(rpm=300), TokenBucket(rpm=600)
+
+PUBCHEM_BUCKET, CHEMBL_BUCKET = _rate_limiters()
 
 def safe_float_format(value, decimal_places=2):
     try:
@@ -37,107 +94,307 @@ def safe_float_format(value, decimal_places=2):
     except:
         return 'N/A'
 
-@retry(stop=stop_after_attempt(3))
-@st.cache_data(ttl=3600, max_entries=3)  # ONLY CHANGE: max_entries=20 → max_entries=3
-def get_biomedical_data(query, input_type="name"):
+def _fmt_series(values, decimal_places=2):
+    """Vectorized safe_float_format for a whole column."""
+    numbers = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce')
+    return numbers.map(lambda x: f"{x:.{decimal_places}f}" if pd.notna(x) else 'N/A').tolist()
+
+def _cache_key(namespace, *parts):
+    # repr of the tuple keeps parts unambiguous, so no query can alias another entry's key
+    return hashlib.sha256(repr((namespace,) + parts).encode()).hexdigest()
+
+def disk_cached(ttl):
+    """Memoize a function's non-None results in the disk cache for ttl seconds."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = _cache_key(func.__name__, *args)
+            value = cache.get(key)
+            if value is None:
+                value = func(*args)
+                if value is not None:
+                    cache.set(key, value, expire=ttl)
+            return value
+        return wrapper
+    return decorator
+
+def _is_transient(exc):
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(exc, requests.HTTPError) and exc.response is not None and exc.response.status_code >= 500
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.3, max=4),
+    retry=retry_if_exception(_is_transient),
+    reraise=True
+)
+def _http_request(method, url, bucket, **kwargs):
+    """Send one rate-limited request, retrying only that request on network errors and 5xx."""
+    bucket.acquire()
+    # Short connect timeout so an unreachable host fails fast instead of stalling each attempt
+    response = SESSION.request(method, url, timeout=(3.05, 15), **kwargs)
+    logging.debug(f"{method} {response.url} -> {response.status_code}")
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response
+
+def _chembl_get(resource, **params):
+    params = {k: ",".join(v) if isinstance(v, (list, tuple, set)) else v for k, v in params.items()}
+    params['format'] = 'json'
+    response = _http_request("GET", f"{CHEMBL_API}/{resource}", CHEMBL_BUCKET, params=params)
+    response.raise_for_status()
+    return response.json()
+
+def _pubchem_properties(query, namespace):
+    # POST keeps SMILES with '/' or '#' out of the URL path
+    response = _http_request(
+        "POST", f"{PUBCHEM_API}/compound/{namespace}/property/{PUBCHEM_PROPERTIES}/JSON",
+        PUBCHEM_BUCKET, data={namespace: query}
+    )
+    # 404 is no match; 400 is an identifier PubChem can't parse (malformed SMILES/InChIKey)
+    if response.status_code in (400, 404):
+        return None
+    response.raise_for_status()
+    props = response.json()['PropertyTable']['Properties'][0]
+    return {
+        'cid': props['CID'],
+        'iupac_name': props.get('IUPACName'),
+        'formula': props.get('MolecularFormula'),
+        'weight': float(props['MolecularWeight']) if props.get('MolecularWeight') else None,
+        # PubChem now reports the requested CanonicalSMILES as ConnectivitySMILES
+        'smiles': props.get('CanonicalSMILES') or props.get('ConnectivitySMILES'),
+        'inchi_key': props.get('InChIKey')
+    }
+
+def _pubchem_compound(query, namespace):
+    PUBCHEM_BUCKET.acquire()
+    compounds = get_compounds(
+        query, namespace=namespace,
+        fields=["cid", "iupac_name", "molecular_formula", "molecular_weight", "canonical_smiles", "inchikey"]
+    )
+    if not compounds:
+        return None
+    compound = compounds[0]
+    return {
+        'cid': compound.cid,
+        'iupac_name': compound.iupac_name,
+        'formula': compound.molecular_formula,
+        'weight': float(compound.molecular_weight) if compound.molecular_weight else None,
+        'smiles': compound.canonical_smiles,
+        'inchi_key': compound.inchikey
+    }
+
+@disk_cached(PUBCHEM_TTL)
+def _pubchem_lookup(query, namespace):
+    try:
+        return _pubchem_properties(query, namespace)
+    except Exception as e:
+        # Only an outage is worth a second request; other errors would fail the same way
+        if not _is_transient(e):
+            raise
+        logging.warning(f"PubChem REST lookup failed, falling back to pubchempy: {e}")
+        return _pubchem_compound(query, namespace)
+
+@disk_cached(CHEMBL_ID_TTL)
+def _chembl_id_lookup(method, value):
+    page = _chembl_get("molecule", **{method: value}, only=["molecule_chembl_id"], limit=1)
+    results = page['molecules']
+    return results[0]['molecule_chembl_id'] if results else None
+
+@disk_cached(CHEMBL_ACTIVITY_TTL)
+def _chembl_activities(chembl_id):
+    page = _chembl_get(
+        "activity",
+        molecule_chembl_id=chembl_id,
+        standard_type__in=["IC50", "Ki", "Kd", "EC50", "AC50", "Potency"],
+        standard_relation="=",
+        standard_units__in=["nM", "μM"],
+        only=[
+            'target_chembl_id', 'standard_value', 'standard_units',
+            'standard_type', 'assay_description', 'pchembl_value'
+        ],
+        limit=15
+    )
+    activities = page['activities']
+
+    # One batched query resolves every target the activities point at
+    target_ids = {act['target_chembl_id'] for act in activities}
+    targets_by_id = {}
+    if target_ids:
+        page = _chembl_get(
+            "target",
+            target_chembl_id__in=sorted(target_ids),
+            only=['target_chembl_id', 'pref_name'],
+            limit=len(target_ids)
+        )
+        targets_by_id = {row['target_chembl_id']: row for row in page['targets']}
+    return activities, targets_by_id
+
+async def _lookup_chembl_id(method, value):
+    return await _run_blocking(_chembl_id_lookup, method, value)
+
+async def _first_chembl_id(lookup_methods, data):
+    results = await asyncio.gather(
+        *(_lookup_chembl_id(method, value) for method, value in lookup_methods),
+        return_exceptions=True
+    )
+    errors = []
+    for (method, _), result in zip(lookup_methods, results):
+        if isinstance(result, Exception):
+            data['debug_log'].append(f"ChEMBL lookup failed via {method}: {result}")
+            errors.append(result)
+        elif result:
+            return result
+    if errors and len(errors) == len(lookup_methods):
+        raise errors[-1]
+    return None
+
+async def _gather_biomedical_data(query, input_type):
     data = {
         'cid': None, 
         'name': query, 
-        'targets': [], 
-        'proteins': [], 
-        'bioactivities': [],
-        'debug_log': []
+        'bioactivities': {},
+        'debug_log': [],
+        # Set when PubChem properties or ChEMBL activities could not be fetched, as
+        # opposed to errors the fetch recovered from; such results are never cached
+        'incomplete': False
     }
-    
-    # --- PubChem Fetch ---
-    try:
-        compounds = get_compounds(query, namespace=input_type, fields=["cid", "iupac_name", "molecular_formula", "molecular_weight", "canonical_smiles", "inchikey"])
-        if not compounds:
-            st.warning(f"No PubChem match for: {query}")
-            return None
-        compound = compounds[0]
+
+    # Lookups that only need the raw query run alongside the PubChem fetch
+    direct_lookups = []
+    if input_type == "name":
+        direct_lookups.append(("molecule_synonyms__molecule_synonym__iexact", query))
+    elif input_type == "inchikey":
+        direct_lookups.append(("molecule_structures__standard_inchi_key", query))
+    elif input_type == "smiles":
+        direct_lookups.append(("molecule_structures__canonical_smiles", query))
+
+    # --- PubChem Fetch + direct ChEMBL lookups ---
+    compound, chembl_id = await asyncio.gather(
+        _run_blocking(_pubchem_lookup, query, input_type),
+        _first_chembl_id(direct_lookups, data),
+        return_exceptions=True
+    )
+    if isinstance(compound, Exception) and isinstance(chembl_id, Exception):
+        # Neither source answered, most likely we're offline; let the caller report it
+        raise compound
+    if isinstance(compound, Exception):
+        data['debug_log'].append(f"PubChem error: {compound}")
+        data['incomplete'] = True
+    elif compound is None:
+        st.warning(f"No PubChem match for: {query}")
+        return None
+    else:
         data.update({
-            'cid': compound.cid,
-            'name': compound.iupac_name or query,
-            'formula': compound.molecular_formula,
-            'weight': float(compound.molecular_weight) if compound.molecular_weight else None,
-            'smiles': compound.canonical_smiles,
-            'inchi_key': compound.inchikey
+            'cid': compound['cid'],
+            'name': compound['iupac_name'] or query,
+            'formula': compound['formula'],
+            'weight': compound['weight'],
+            'smiles': compound['smiles'],
+            'inchi_key': compound['inchi_key']
         })
-    except Exception as e:
-        data['debug_log'].append(f"PubChem error: {e}")
+    direct_lookup_ok = not isinstance(chembl_id, Exception)
+    # A transient failure means ChEMBL itself is down; further lookups against it can't succeed
+    chembl_down = not direct_lookup_ok and _is_transient(chembl_id)
+    if not direct_lookup_ok:
+        # _first_chembl_id has already logged the failure it re-raised
+        chembl_id = None
+    lookup_failed = not direct_lookup_ok
 
     # --- ChEMBL Fetch ---
     try:
-        lookup_methods = []
-        if input_type == "name":
-            lookup_methods.append(("molecule_synonyms__molecule_synonym__iexact", query))
-        if data.get('inchi_key'):
-            lookup_methods.append(("molecule_structures__standard_inchi_key", data['inchi_key']))
-        if data.get('smiles'):
-            lookup_methods.append(("molecule_structures__canonical_smiles", data['smiles']))
-
-        chembl_id = None
-        for method, value in lookup_methods:
-            try:
-                results = list(new_client.molecule.filter(**{method: value}).only("molecule_chembl_id"))
-                if results:
-                    chembl_id = results[0]['molecule_chembl_id']
+        # ChEMBL already answered the InChIKey query with no match; a weaker SMILES match won't help
+        inchi_key_answered = direct_lookup_ok and input_type == "inchikey"
+        if not chembl_id and not inchi_key_answered and not chembl_down:
+            lookup_methods = []
+            if data.get('inchi_key'):
+                lookup_methods.append(("molecule_structures__standard_inchi_key", data['inchi_key']))
+            if data.get('smiles'):
+                lookup_methods.append(("molecule_structures__canonical_smiles", data['smiles']))
+            lookup_methods = [m for m in lookup_methods if m not in direct_lookups]
+            # InChIKey identifies the molecule on its own; SMILES canonicalization differs
+            # between PubChem and ChEMBL, so it is only tried if the stronger lookup errors
+            for method, value in lookup_methods:
+                try:
+                    chembl_id = await _lookup_chembl_id(method, value)
+                    lookup_failed = False
                     break
-            except Exception as e:
-                data['debug_log'].append(f"ChEMBL lookup failed via {method}: {e}")
+                except Exception as e:
+                    data['debug_log'].append(f"ChEMBL lookup failed via {method}: {e}")
+                    lookup_failed = True
+                    if _is_transient(e):
+                        break
+
+        if not chembl_id and lookup_failed:
+            data['incomplete'] = True
 
         if chembl_id:
-            activities = new_client.activity.filter(
-                molecule_chembl_id=chembl_id,
-                standard_type__in=["IC50", "Ki", "Kd", "EC50", "AC50", "Potency"],
-                standard_relation="=",
-                standard_units__in=["nM", "μM"]
-            ).only([
-                'target_chembl_id', 'standard_value', 'standard_units',
-                'standard_type', 'assay_description', 'pchembl_value'
-            ])[:15]
+            activities, targets_by_id = await _run_blocking(_chembl_activities, chembl_id)
 
+            # Filled column-wise so the DataFrame is built straight from the columns
+            targets_col, values_col, units_col, pic50_col, evidence_col = [], [], [], [], []
             for act in activities:
                 try:
-                    target = new_client.target.get(act['target_chembl_id'])
-                    data['bioactivities'].append({
-                        'target': target['pref_name'],
-                        'value': safe_float_format(act.get('standard_value')),
-                        'unit': act.get('standard_units'),
-                        'pIC50': safe_float_format(act.get('pchembl_value')),
-                        'evidence': act.get('assay_description', 'No description'),
-                        'source': 'ChEMBL'
-                    })
-                    if act['target_chembl_id'] not in data['targets']:
-                        data['targets'].append(act['target_chembl_id'])
+                    target = targets_by_id[act['target_chembl_id']]
+                    targets_col.append(target['pref_name'])
+                    values_col.append(act.get('standard_value'))
+                    units_col.append(act.get('standard_units'))
+                    pic50_col.append(act.get('pchembl_value'))
+                    evidence_col.append(act.get('assay_description', 'No description'))
                 except Exception as e:
                     data['debug_log'].append(f"Activity processing error: {e}")
+
+            if targets_col:
+                data['bioactivities'] = {
+                    'target': targets_col,
+                    'value': _fmt_series(values_col),
+                    'unit': units_col,
+                    'pIC50': _fmt_series(pic50_col),
+                    'evidence': evidence_col,
+                    'source': ['ChEMBL'] * len(targets_col)
+                }
     except Exception as e:
         data['debug_log'].append(f"ChEMBL API failed: {e}")
+        data['incomplete'] = True
+
+    return data
+
+def _serve_stale(cached, reason):
+    fetched_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(cached['fetched_at']))
+    st.warning(f"⚠ Live lookup failed, showing cached results from {fetched_at}")
+    st.session_state['debug_log'] = [f"Live lookup failed: {reason}"]
+    return cached['data']
+
+def get_biomedical_data(query, input_type="name"):
+    key = _cache_key("get_biomedical_data", query, input_type)
+    cached = cache.get(key)
+    if cached and time.time() - cached['fetched_at'] < CACHE_TTL:
+        st.session_state['debug_log'] = []
+        return cached['data']
 
-    # --- Protein Targets ---
     try:
-        for target_id in data['targets'][:3]:
-            try:
-                target_info = new_client.target.get(target_id)
-                if target_info.get('target_components'):
-                    acc = target_info['target_components'][0].get('accession')
-                    if acc:
-                        data['proteins'].append({
-                            'accession': acc,
-                            'name': target_info['pref_name'],
-                            'source': "UniProt"
-                        })
-            except Exception as e:
-                data['debug_log'].append(f"UniProt fetch failed for {target_id}: {e}")
+        data = asyncio.run(_gather_biomedical_data(query, input_type))
     except Exception as e:
-        data['debug_log'].append(f"UniProt block error: {e}")
+        if not cached:
+            raise
+        logging.warning(f"Serving stale cache for {query!r}: {e}")
+        return _serve_stale(cached, e)
 
+    if data is not None:
+        errors = data['debug_log']
+        incomplete = data['incomplete']
+        # A partial result must neither replace a good entry nor be cached itself
+        if incomplete and cached:
+            logging.warning(f"Serving stale cache for {query!r}: {errors}")
+            return _serve_stale(cached, "; ".join(errors))
+        st.session_state['debug_log'] = errors
+        data = {field: data[field] for field in VIEW_FIELDS if field in data}
+        if not incomplete:
+            cache.set(key, {'data': data, 'fetched_at': time.time()}, expire=STALE_TTL)
     return data
 
 def main():
-    nlp = load_models()
     st.title("Drug-Info")
 
     col1, col2 = st.columns([3, 1])
@@ -155,7 +412,13 @@ def main():
                 "SMILES": "smiles",
                 "InChI Key": "inchikey"
             }
-            data = get_biomedical_data(query.strip(), input_map[input_type])
+            try:
+                data = get_biomedical_data(query.strip(), input_map[input_type])
+            except OSError as e:
+                # requests' exceptions and pubchempy's URLError are both OSErrors
+                logging.error(f"Lookup failed for {query!r}: {e}")
+                st.error("⚠ Could not reach PubChem/ChEMBL. Check your internet connection and try again.")
+                st.stop()
 
             if data:
                 st.success("✅ Data retrieved successfully")
@@ -172,7 +435,7 @@ def main():
                         data.get('inchi_key', 'N/A')
                     ]
                 })
-                st.dataframe(chem_props)
+                st.dataframe(chem_props, use_container_width=True, hide_index=True)
 
                 st.subheader("📊 Bioactivities (Top 15)")
                 if data.get('bioactivities'):
@@ -182,7 +445,7 @@ def main():
                     st.warning("No bioactivity data found. Try another compound.")
 
                 with st.expander("🐛 Debug Log", expanded=False):
-                    st.code("\n".join(data.get("debug_log", [])))
+                    st.code("\n".join(st.session_state.get("debug_log", [])))
             else:
                 st.error("❌ No data found for this compound")
 